@@ -1,36 +1,39 @@
 #!/usr/bin/env bashio
 set +u
 
+# only BORG_* variables are exported, borg reads them from its environment
 export BORG_BASE_DIR=/config/borg
 export BORG_CACHE_DIR=${BORG_BASE_DIR}/cache
-export BORG_PASSPHRASE=$(bashio::config 'borg_passphrase')
 export BORG_REPO=""
-export _BORG_TOBACKUP=/backup/borg_unpacked
-export _BORG_SSH_KNOWN_HOSTS=${BORG_BASE_DIR}/known_hosts
-export _BORG_SSH_KEY=${BORG_BASE_DIR}/keys/borg_backup
-export _BORG_REPO_URL=$(bashio::config 'borg_repo_url')
-export _BORG_USER=$(bashio::config 'borg_user')
-export _BORG_HOST=$(bashio::config 'borg_host')
-export _BORG_REPONAME=$(bashio::config 'borg_reponame')
-export _BORG_COMPRESSION=$(bashio::config 'borg_compression')
-export _BORG_BACKUP_DEBUG="$(bashio::config 'borg_backup_debug')"
-export _BORG_BACKUP_KEEP_SNAPSHOTS="$(bashio::config 'borg_backup_keep_snapshots')"
-export _BORG_DEBUG=''
-export borg_error=0
-
-export BORG_RSH="ssh -o UserKnownHostsFile=${_BORG_SSH_KNOWN_HOSTS} -i ${_BORG_SSH_KEY} $(bashio::config 'borg_ssh_params')"
+_BORG_TOBACKUP=/backup/borg_unpacked
+_BORG_SSH_KNOWN_HOSTS=${BORG_BASE_DIR}/known_hosts
+_BORG_SSH_KEY=${BORG_BASE_DIR}/keys/borg_backup
+# marker records which repository is known to be initialized
+_BORG_REPO_MARKER=${BORG_BASE_DIR}/.repo_initialized
+# read all addon options in one jq pass instead of one per option
+IFS=$'\x1f' read -r BORG_PASSPHRASE _BORG_REPO_URL _BORG_USER _BORG_HOST \
+    _BORG_REPONAME _BORG_COMPRESSION _BORG_BACKUP_DEBUG _BORG_BACKUP_KEEP_SNAPSHOTS \
+    _BORG_SSH_PARAMS < <(jq -r '[.borg_passphrase, .borg_repo_url, .borg_user,
+        .borg_host, .borg_reponame, .borg_compression, .borg_backup_debug,
+        .borg_backup_keep_snapshots, .borg_ssh_params]
+        | map(. // "" | tostring) | join("\u001f")' /data/options.json)
+export BORG_PASSPHRASE
+_BORG_DEBUG=''
+# pigz offloads reading, writing and crc checks to separate threads
+_BORG_GZIP_PROG=$(command -v pigz || echo gzip)
+borg_error=0
+
+export BORG_RSH="ssh -o UserKnownHostsFile=${_BORG_SSH_KNOWN_HOSTS} -i ${_BORG_SSH_KEY} ${_BORG_SSH_PARAMS}"
 
 mkdir -p $(dirname ${_BORG_SSH_KEY}) ${BORG_CACHE_DIR}
+# leftovers of interrupted runs
+rm -rf ${_BORG_TOBACKUP}.trash-*
 
 ##### passwords crap
 if [ ${#BORG_PASSPHRASE} -eq 0 ];then
     export BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK=yes
     unset BORG_PASSPHRASE
 fi
-# set zstd as default compression
-if [ ${#_BORG_COMPRESSION} -eq 0 ];then
-    _BORG_COMPRESSION="zstd"
-fi
 
 if [ ${#BORG_BACKUP_DEBUG} -ne 0 ];then
     _BORG_DEBUG="--debug"
@@ -85,7 +88,7 @@ function add_borg_host_to_known_hosts {
 function generate_ssh_key {
     if ! bashio::fs.file_exists "${_BORG_SSH_KEY}"; then
         bashio::log.info "Generating borg backup ssh keys..."
-        ssh-keygen -P '' -f ${_BORG_SSH_KEY}
+        ssh-keygen -t ed25519 -P '' -f ${_BORG_SSH_KEY}
         bashio::log.info "key generated"
     fi
 }
@@ -99,53 +102,168 @@ function show_ssh_key {
     bashio::log.info "************ SNIP **********************"
 }
 
+function mark_repo_initialized {
+    echo "${BORG_REPO}" > ${_BORG_REPO_MARKER}
+}
+
 function init_borg_repo {
-    if ! bashio::fs.directory_exists "${BORG_BASE_DIR}/.config/borg/security"; then
-        bashio::log.info "Initializing backup repository"
-        borg init --encryption=repokey-blake2 --debug
+    local initialized=""
+    if bashio::fs.file_exists "${_BORG_REPO_MARKER}"; then
+        read -r initialized < ${_BORG_REPO_MARKER}
+        if [ "${initialized}" == "${BORG_REPO}" ]; then
+            return
+        fi
     fi
+    bashio::log.info "Initializing backup repository"
+    borg init --encryption=repokey-blake2 --debug 2>&1 | tee /tmp/borg_init_$$
+    local init_res=${PIPESTATUS[0]}
+    # an existing repository needs no init on following runs either
+    if [ ${init_res} -eq 0 ] || grep -q "repository already exists" /tmp/borg_init_$$; then
+        mark_repo_initialized
+    fi
+    rm -f /tmp/borg_init_$$
 }
 
-function borg_create_backup {
-    export BACKUP_TIME=$(date  +'%Y-%m-%d-%H:%M')
+# number of cpus usable by the container, honoring cgroup cpu quota
+function cpu_count {
+    local cpus=$(nproc) quota period
+    if [ -r /sys/fs/cgroup/cpu.max ]; then
+        read -r quota period < /sys/fs/cgroup/cpu.max
+    elif [ -r /sys/fs/cgroup/cpu/cpu.cfs_quota_us ]; then
+        quota=$(cat /sys/fs/cgroup/cpu/cpu.cfs_quota_us)
+        period=$(cat /sys/fs/cgroup/cpu/cpu.cfs_period_us)
+    fi
+    if [[ ${quota} =~ ^[0-9]+$ && ${period} -gt 0 ]]; then
+        quota=$(( (quota + period - 1) / period ))
+        [ ${quota} -lt ${cpus} ] && cpus=${quota}
+    fi
+    echo ${cpus}
+}
+
+function extract_nested_archive {
+    local TGZDIR=${1%.tar.gz}
+    mkdir -p ${TGZDIR}
+    tar -C ${TGZDIR} -I ${_BORG_GZIP_PROG} -xf $1
+    rm -f $1 # remove compressed file
+}
+
+function create_ha_snapshot {
     bashio::log.info "Creating snapshot"
-    ha snapshots new --name borg-${BACKUP_TIME} --raw-json --no-progress |tee /tmp/borg_backup_$$
+    ha snapshots new --name borg-${BACKUP_TIME} --raw-json --no-progress > /tmp/borg_backup_$$
+}
+
+function remove_unpacked {
+    # one rm per unpacked archive (<root>/<slug>/<archive>/) so unlinks overlap
+    for dir in $1/*/*/ ; do
+        rm -rf ${dir} &
+    done
+    wait
+    rm -rf $1
+}
+
+function borg_create_backup {
+    # snapshot was started in background at startup
+    if ! wait ${_BORG_SNAPSHOT_PID}; then
+        cat /tmp/borg_backup_$$
+        bashio::log.error "Failed creating ha snapshot"
+        exit -1
+    fi
+    cat /tmp/borg_backup_$$
     bashio::log.info "Snapshot done"
-    export SNAP_RES=$(jq < /tmp/borg_backup_$$ .result -r)
+    SNAP_RES=$(jq < /tmp/borg_backup_$$ .result -r)
     # if it is not ok something failed and should be logged anyway
-    if [ $SNAP_RES != 'ok' ];then
+    if [ "${SNAP_RES}" != 'ok' ];then
         bashio::log.error "Failed creating ha snapshot"
         exit -1
     fi
-    export SNAP_SLUG=$(jq < /tmp/borg_backup_$$ -r .data.slug)
+    SNAP_SLUG=$(jq < /tmp/borg_backup_$$ -r .data.slug)
     mkdir -p ${_BORG_TOBACKUP}/${SNAP_SLUG}
     tar -C ${_BORG_TOBACKUP}/${SNAP_SLUG} -xf /backup/${SNAP_SLUG}.tar
+    # nested archives are independent, unpack them in parallel
+    local cpus=$(cpu_count)
+    local max_jobs=${cpus}
     for targz in ${_BORG_TOBACKUP}/${SNAP_SLUG}/*.tar.gz ; do
-                TGZDIR=$(echo ${targz}|sed -e 's/.tar.gz//g')
-                mkdir -p ${TGZDIR}
-                tar -C ${TGZDIR} -zxf  $targz
-                rm -f $targz # remove compressed file
+        # reuse the first freed slot, large archives do not hold the queue
+        while [ $(jobs -rp | wc -l) -ge ${max_jobs} ]; do
+            wait -n
+        done
+        extract_nested_archive ${targz} &
     done
+    wait
 
+    # default compression, auto skips data that does not compress
+    # and lz4 keeps single cpu devices from being bound by compression
+    if [ ${#_BORG_COMPRESSION} -eq 0 ];then
+        _BORG_COMPRESSION="auto,zstd,3"
+        if [ ${cpus} -le 1 ];then
+            _BORG_COMPRESSION="lz4"
+        fi
+    fi
     bashio::log.info "Start borg create"
-    borg create ${_BORG_DEBUG} --compression ${_BORG_COMPRESSION} --stats ::"${BACKUP_TIME}" ${_BORG_TOBACKUP}/${SNAP_SLUG}
+    local borg_args=(${_BORG_DEBUG} --compression "${_BORG_COMPRESSION}" --stats)
+    if borg create "${borg_args[@]}" ::"${BACKUP_TIME}" "${_BORG_TOBACKUP}/${SNAP_SLUG}"; then
+        mark_repo_initialized
+    fi
     bashio::log.info "End borg create --stats..."
-    # cleanup
-    rm -rf  ${_BORG_TOBACKUP} /tmp/borg_backup_$$
+    # cleanup runs in background while old snapshots are pruned
+    local trash=${_BORG_TOBACKUP}.trash-$$
+    mv ${_BORG_TOBACKUP} ${trash}
+    rm -f /tmp/borg_backup_$$
+    remove_unpacked ${trash} &
+    _BORG_CLEANUP_PID=$!
+}
+
+# call ha cli with a bounded wait, retrying transient failures with backoff
+function ha_call {
+    local out attempt res
+    for attempt in 1 2 3; do
+        out=$(timeout 60 ha "$@")
+        res=$?
+        if [ ${res} -eq 0 ]; then
+            [ ${#out} -gt 0 ] && echo "${out}"
+            return 0
+        elif [ ${res} -eq 124 ]; then
+            bashio::log.warning "'ha $*' timed out, it may still have completed (attempt ${attempt})"
+        else
+            bashio::log.warning "'ha $*' failed (attempt ${attempt})"
+        fi
+        [ ${attempt} -lt 3 ] && sleep ${attempt}
+    done
+    return 1
+}
 
+function remove_snapshot {
+    bashio::log.info "Removing snapshot $2 with slug id $1 started"
+    if ha_call snapshots remove $1; then
+        bashio::log.info "Removed snapshot $2 with slug id $1"
+    else
+        bashio::log.error "Failed removing snapshot $2 with slug id $1, it may already be gone if an attempt timed out"
+    fi
 }
 
 function clean_old_snapshots {
-    ha snapshots reload
-    export ALL_SNAPS=$(ha snapshots --raw-json|jq '.data.snapshots[].name' -r| sort | wc -l)
-    export DISCARD_SNAPS=$(($ALL_SNAPS - $_BORG_BACKUP_KEEP_SNAPSHOTS))
-    export ALL_SNAPS=$(ha snapshots --raw-json|jq '.data.snapshots[].name' -r| sort | head -n ${DISCARD_SNAPS})
-    for snap in $ALL_SNAPS ; do
-        SLUG=$(ha snapshots --raw-json |jq -r '.data.snapshots[]|select (.name=="'${snap}'")|.slug')
-        bashio::log.info "Removing snapshot ${snap} with slug id $SLUG started"
-        ha snapshots remove $SLUG
-        bashio::log.info "Removed snapshot ${snap} with slug id $SLUG"
-    done
+    ha_call snapshots reload
+    # fetch snapshot list once and derive everything from it
+    local snaps_json
+    if ! snaps_json=$(ha_call snapshots --raw-json); then
+        bashio::log.error "Failed listing snapshots, skipping cleanup"
+        return
+    fi
+    local ALL_SNAPS=$(jq '.data.snapshots | length' <<< "${snaps_json}")
+    local DISCARD_SNAPS=$(($ALL_SNAPS - $_BORG_BACKUP_KEEP_SNAPSHOTS))
+    # removals are independent, run a few of them concurrently
+    local pids=()
+    while read -r SLUG snap; do
+        [ ${#SLUG} -eq 0 ] && continue
+        # reuse the first freed slot instead of waiting on the oldest removal
+        while [ $(jobs -rp | wc -l) -ge 8 ]; do
+            wait -n
+        done
+        remove_snapshot "${SLUG}" "${snap}" &
+        pids+=($!)
+    done < <(jq -r --argjson discard "${DISCARD_SNAPS}" \
+        '.data.snapshots | sort_by(.name) | .[:([$discard, 0] | max)][] | "\(.slug) \(.name)"' <<< "${snaps_json}")
+    [ ${#pids[@]} -gt 0 ] && wait ${pids[@]}
     bashio::log.info "Cleanup of old snapshots done"
 }
 
@@ -154,6 +272,10 @@ if [[ $borg_error -gt 0 ]];then
     bashio::log.warning "error state bailing out..."
     exit -1
 fi
+printf -v BACKUP_TIME '%(%Y-%m-%d-%H:%M)T' -1
+# creating snapshot takes a while, prepare borg side meanwhile
+create_ha_snapshot &
+_BORG_SNAPSHOT_PID=$!
 generate_ssh_key
 set_borg_repo_path
 add_borg_host_to_known_hosts
@@ -162,3 +284,4 @@ init_borg_repo
 show_ssh_key
 borg_create_backup
 clean_old_snapshots
+wait ${_BORG_CLEANUP_PID}